@@ -1,24 +1,27 @@
 """Assessment of read_fillet results."""
 
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
-import pickle
 
 import numpy as np
 import pandas as pd
+from xopen import xopen
 
 import duplex_tools
 
 
+def read_ids(path):
+    """Load a read list written by split_on_adapter."""
+    with xopen(path, 'rt') as handle:
+        return set(handle.read().split())
+
+
 def assess(
         seqkit_stats_nosecondary, edited_reads, unedited_reads,
         split_multiple_times, suffix=None):
     """Run assessment."""
-    with open(edited_reads, 'rb') as handle:
-        edited_reads = pickle.load(handle)
-    with open(unedited_reads, 'rb') as handle:
-        unedited_reads = pickle.load(handle)
-    with open(split_multiple_times, 'rb') as handle:
-        split_multiple_times = pickle.load(handle)
+    edited_reads = read_ids(edited_reads)
+    unedited_reads = read_ids(unedited_reads)
+    split_multiple_times = read_ids(split_multiple_times)
 
     txt = pd.read_csv(
         seqkit_stats_nosecondary,
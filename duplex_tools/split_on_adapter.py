@@ -1,21 +1,23 @@
 """Split reads containing internal adapter sequences."""
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
-from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import functools
-import gzip
 from pathlib import Path
-import pickle
+import shutil
 import sys
+import tempfile
 import math
 
 import edlib
-from more_itertools import pairwise
+from more_itertools import chunked, pairwise
 from natsort import natsorted
-import numpy as np
 from pyfastx import Fastx
 from tqdm import tqdm
+from xopen import xopen
 
 import duplex_tools
+from duplex_tools.utils import available_cpus
 
 EDIT_THRESHOLDS = {'PCR': 50, 'Native': 9} #defaults:'PCR':45,'Native':9#####        #PCR5;Native5 #PCR 14 for linkers
 mask_size_default_head = 5 #0 #3 #5
@@ -26,12 +28,21 @@ mask_size_default_N = 11 #0 #6 #11
 #--decided based on the adapter--#
 HEAD_ADAPTER = ''
 TAIL_ADAPTER = ''
-rctrans = str.maketrans('ACGT', 'TGCA')
+rctrans = bytes.maketrans(b'ACGTacgt', b'TGCAtgca')
+# N in a target is a wildcard matching any base. Built once rather than
+# on every call to edlib.
+N_EQUALITIES = (('N', 'A'), ('N', 'C'), ('N', 'G'), ('N', 'T'))
+# Reads per unit of work handed to the alignment threads.
+BATCH_SIZE = 1000
+# Lists of read ids written alongside the split reads, one id per line.
+READ_LISTS = ('edited', 'unedited', 'split_multiple_times')
 
 
 def rev_comp(seq):
     """Reverse complement a DNA sequence."""
-    return str.translate(seq, rctrans)[::-1]
+    if isinstance(seq, bytes):
+        return seq.translate(rctrans)[::-1]
+    return seq.encode().translate(rctrans)[::-1].decode()
 
 
 def build_targets(
@@ -104,15 +115,13 @@ def build_targets(
     else:
         middle_sequence = n_replacement
 
+    core = (tail_adapter[:len(tail_adapter) - n_bases_to_mask_tail]
+            + middle_sequence
+            + head_adapter[n_bases_to_mask_head:])
     targets = {
-        'Native': [
-            (tail_adapter[:len(tail_adapter) - n_bases_to_mask_tail]
-                + middle_sequence
-                + head_adapter[n_bases_to_mask_head:])],
+        'Native': [core],
         'PCR': [
-            (rev_comp(x)
-                + tail_adapter[:len(tail_adapter) - n_bases_to_mask_tail]
-                + middle_sequence + head_adapter[n_bases_to_mask_head:] + y)
+            rev_comp(x) + core + y
             for x in pcr_primers for y in pcr_primers]
     }
     print(targets)
@@ -120,29 +129,48 @@ def build_targets(
 
 #logger.info(f'Adapter: {adapter_type}\n')
 
+@functools.lru_cache(maxsize=None)
+def hw_aligner(k):
+    """Return edlib's infix aligner with N wildcards, bounded at k."""
+    return functools.partial(
+        edlib.align, mode="HW", k=k, additionalEqualities=N_EQUALITIES)
+
+
 def find_mid_adaptor(
         seq, targets, print_alignment=False, print_threshold=10,
-        print_id=None, trim_start=200, trim_end=200):
-    """Find adapters in middle of reads."""
+        print_id=None, trim_start=200, trim_end=200, edit_threshold=None):
+    """Find adapters in middle of reads.
+
+    `seq` may be str or ASCII bytes. With `edit_threshold`, a read where
+    no target aligns below it returns an `editDistance` of -1.
+    """
     seq = seq[trim_start:-trim_end or None]  # remove start and end adaptor
-    results = [
-        edlib.align(
-            target, seq, mode="HW", task="path",
-            additionalEqualities=(
-                ('N', 'A'), ('N', 'C'), ('N', 'G'), ('N', 'T')))
-        for target in targets]
+    if isinstance(seq, str):
+        seq = seq.encode()
+    k = -1
+    if edit_threshold is not None:
+        k = edit_threshold - 1
+        if print_alignment:
+            k = max(k, print_threshold - 1)
+    align = hw_aligner(k)
+    # distances only: the traceback is computed for the winner alone
+    results = [align(target, seq, task="distance") for target in targets]
     if print_alignment:
-        alignments = [
-            edlib.getNiceAlignment(result, target, seq)
-            for result, target in zip(results, targets)
-            if result['cigar'] is not None]
-        for alignment, result in zip(alignments, results):
-            if result['editDistance'] < print_threshold:
+        text = seq.decode()
+        for result, target in zip(results, targets):
+            if -1 < result['editDistance'] < print_threshold:
+                result = align(target, seq, task="path")
+                if result['cigar'] is None:
+                    continue
+                alignment = edlib.getNiceAlignment(result, target, text)
                 print(f"{print_id} editdistance-{result['editDistance']}")
                 print("\n".join(alignment.values()))
 
-    i = np.argmin([x['editDistance'] for x in results])
-    res = results[i]
+    hits = [i for i, x in enumerate(results) if x['editDistance'] != -1]
+    if not hits:
+        return results[0]
+    i = min(hits, key=lambda i: results[i]['editDistance'])
+    res = align(targets[i], seq, task="path")
     if res['cigar'] is not None:
         res['locations'] = [
             (x + trim_start, y + trim_start)
@@ -157,18 +185,56 @@ def write_match_to_fasta(file, seq, start, end, read_id):
     seq_left = seq[(start + matchlen_half - 100):start]
     seq_mid = seq[start:end]
     seq_right = seq[end:(end - matchlen_half + 100)]
-    fullseq = ''.join([seq_left, seq_mid, seq_right])
-    if len(fullseq) > 0:
-        file.write(f'>{read_id}\n{fullseq}\n')
+    # hand the slices straight to the file rather than joining them first
+    if seq_left or seq_mid or seq_right:
+        file.writelines(
+            ('>', read_id, '\n', seq_left, seq_mid, seq_right, '\n'))
+
+
+def write_fastq(file, header, seq, qual):
+    """Write a fastq record to a binary file.
+
+    The sequence and quality bytes are handed over as they are rather
+    than being formatted into one record string first.
+    """
+    file.writelines(
+        (b'@', header.encode(), b'\n', seq, b'\n+\n', qual, b'\n'))
 
 
 def deduplicate_locations_first_key(result):
-    """Deduplicate locations."""
-    result['locations'] = sorted(
-        list({x: y for x, y in reversed(result['locations'])}.items()))
+    """Deduplicate locations, keeping the first end for each start."""
+    locations = result['locations']
+    if len(locations) > 1:
+        first = {}
+        for start, end in locations:
+            first.setdefault(start, end)
+        result['locations'] = sorted(first.items())
     return result
 
 
+def map_batches_ordered(fn, records, threads=1, batch_size=BATCH_SIZE):
+    """Apply fn to batches of records on a thread pool.
+
+    Yields (record, result) pairs in input order. Only a few batches are
+    in flight at once so the input is never read far ahead of the output.
+
+    :param fn: callable taking a list of records, returning a list
+        of results of the same length.
+    :param records: iterable of records.
+    :param threads: number of worker threads.
+    :param batch_size: number of records per batch.
+    """
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for batch in chunked(records, batch_size):
+            pending.append((batch, executor.submit(fn, batch)))
+            if len(pending) > 2 * threads:
+                batch, future = pending.popleft()
+                yield from zip(batch, future.result())
+        for batch, future in pending:
+            yield from zip(batch, future.result())
+
+
 def process_file(
         fastx, targets, output_dir=None,
         debug_output=False,
@@ -179,8 +245,22 @@ def process_file(
         trim_start=200,
         trim_end=200,
         adapter_type="ONT_sequencing_adapter",
+        threads=1,
+        read_list_prefix=None,
         ):
-    """Run the workflow on a single file."""
+    """Run the workflow on a single file.
+
+    Reads are aligned in batches on `threads` threads (edlib releases
+    the GIL), or one at a time on the calling thread when printing
+    alignments; parsing and writing stay on the calling thread. The ids
+    of edited, unedited and multiply-split reads are streamed to gzipped
+    lists named `{read_list_prefix}_{name}.txt.gz` (by default next to
+    the output fastq) as they are classified.
+
+    :returns: counts of edited, unedited and multiply-split reads, the
+        number of reads written and a dict of read list paths keyed
+        by the names in READ_LISTS.
+    """
     newfastx = fastx.with_name(
         fastx.name.replace('.fastq',
                            '').replace('.gz',
@@ -191,36 +271,80 @@ def process_file(
         newfasta = Path(output_dir) / Path(
             fastx.stem.split('.')[0] + '_middle').with_suffix('.fasta')
         fasta = open(newfasta, 'w')
-    edited_reads = set()
-    unedited_reads = set()
-    split_multiple_times = set()
+    if read_list_prefix is None:
+        read_list_prefix = str(newfastx).replace('.fastq.gz', '')
+    read_lists = {
+        name: Path(f'{read_list_prefix}_{name}.txt.gz')
+        for name in READ_LISTS}
+    nedited = nunedited = nmulti = 0
+
+    print_threshold = edit_threshold + print_threshold_delta
+    # Every base of a target missing from the middle window costs an edit,
+    # so reads whose window is this short can never align below threshold
+    # and are written out without running edlib at all.
+    threshold = edit_threshold
+    if print_alignment:
+        threshold = max(threshold, print_threshold)
+    min_window = min(len(target) for target in targets) - threshold + 1
+    min_length = 0
+    if min_window > 0:
+        min_length = min_window + trim_start + trim_end
+
+    def find_batch(batch):
+        # loop invariants bound locally and passed positionally: this
+        # runs once per read
+        find = find_mid_adaptor
+        return [
+            None if len(seq) < min_length
+            else find(
+                seq, targets, print_alignment, print_threshold, read_id,
+                trim_start, trim_end, edit_threshold)
+            for read_id, seq, _, _ in batch]
 
     nwritten = 0
-    with gzip.open(newfastx, mode='wt', compresslevel=1) as outfh:
-
-        for read_id, seq, qual, comments in \
-                tqdm(Fastx(str(fastx), comment=True), leave=False):
-            result = find_mid_adaptor(
-                seq, targets,
-                print_alignment=print_alignment,
-                print_threshold=edit_threshold + print_threshold_delta,
-                print_id=read_id,
-                trim_start=trim_start,
-                trim_end=trim_end)
+    # compression runs in a helper thread (or pigz) spawned by xopen,
+    # leaving the main thread to parse and align
+    list_opts = dict(mode='wt', compresslevel=1, threads=0)
+    with xopen(newfastx, mode='wb', compresslevel=1, threads=1) as outfh, \
+            xopen(read_lists['edited'], **list_opts) as edited_fh, \
+            xopen(read_lists['unedited'], **list_opts) as unedited_fh, \
+            xopen(read_lists['split_multiple_times'], **list_opts) as multi_fh:
+
+        edited_write = edited_fh.write
+        unedited_write = unedited_fh.write
+        multi_write = multi_fh.write
+        # refresh the bar every 10k reads rather than checking per read
+        records = tqdm(
+            Fastx(str(fastx), comment=True), leave=False,
+            miniters=10000, mininterval=0.5, smoothing=0)
+        if print_alignment:
+            # align in step with the loop below so printed alignments sit
+            # next to the rest of each read's debug output
+            aligned = (
+                (record, find_batch([record])[0]) for record in records)
+        else:
+            aligned = map_batches_ordered(find_batch, records, threads)
+        for (read_id, seq, qual, comments), result in aligned:
             #print("ITIS: ",result)
             #print(read_id,len(result['locations']))
-            if result['editDistance'] < edit_threshold:
+            if result is not None \
+                    and 0 <= result['editDistance'] < edit_threshold:
                 result = deduplicate_locations_first_key(result)
                 print("dedup",result)
                 print("DEDUP",read_id,"splitNs=",len(result['locations']))
                 if not allow_multiple_splits and len(result['locations']) > 1:
-                    outfh.write(f'@{read_id} {comments}\n{seq}\n+\n{qual}\n')
-                    split_multiple_times.add(read_id)
+                    write_fastq(
+                        outfh, f'{read_id} {comments}',
+                        seq.encode(), qual.encode())
+                    multi_write(f'{read_id}\n')
+                    nmulti += 1
                     nwritten += 1
                     continue
                 else:
                     hits = []
-                    edited_reads.add(read_id)
+                    edited_write(f'{read_id}\n')
+                    nedited += 1
+                    seq_b, qual_b = seq.encode(), qual.encode()
                     hitN=0
                     for left_hit, right_hit in pairwise(
                             [(0, 0), *result['locations'], (len(seq),
@@ -260,20 +384,32 @@ def process_file(
 
                         print("calcuated",start,end)
                        
-                        subseq = seq[start:end]
-                        subqual = qual[start:end]
-                        h = (f'@{read_id}_{idx} {comments} {start}->{end}\n'
-                             f'{subseq}\n'
-                             f'+\n'
-                             f'{subqual}\n')
-                        outfh.write(h)
+                        header = f'{read_id}_{idx} {comments} {start}->{end}'
+                        write_fastq(
+                            outfh, header, seq_b[start:end], qual_b[start:end])
                         nwritten += 1
             else:
-                outfh.write(f'@{read_id} {comments}\n{seq}\n+\n{qual}\n')
-                unedited_reads.add(read_id)
+                write_fastq(
+                    outfh, f'{read_id} {comments}',
+                    seq.encode(), qual.encode())
+                unedited_write(f'{read_id}\n')
+                nunedited += 1
     if debug_output:
         fasta.close()
-    return edited_reads, unedited_reads, split_multiple_times, nwritten
+    return nedited, nunedited, nmulti, nwritten, read_lists
+
+
+def merge_read_lists(parts, merged):
+    """Concatenate gzipped read lists into one file, removing the parts.
+
+    gzip members concatenate into a valid gzip stream, so nothing is
+    decompressed.
+    """
+    with open(merged, 'wb') as handle:
+        for part in parts:
+            with open(part, 'rb') as fh:
+                shutil.copyfileobj(fh, handle)
+            part.unlink()
 
 
 def split(
@@ -340,11 +476,11 @@ def split(
         degenerate_bases=degenerate_bases,
         adapter_type=adapter_type,
         n_replacement=n_replacement)[type]
+    # Identical targets would only repeat the same alignment; with empty
+    # PCR primers (ONT_sequencing_adapter) all primer pairs coincide.
+    targets = list(dict.fromkeys(targets))
     if edit_threshold is None:
         edit_threshold = EDIT_THRESHOLDS[type]
-    edited_reads = set()
-    unedited_reads = set()
-    split_multiple_times = set()
     worker = functools.partial(
         process_file,
         targets=targets, output_dir=output_dir,
@@ -358,25 +494,42 @@ def split(
         adapter_type=adapter_type,
     )
 
-    with ProcessPoolExecutor(max_workers=threads) as executor:
-        results = executor.map(worker, fastxs)
-        total_written = 0
-        for edited, unedited, multi, nwritten in results:
-            edited_reads.update(edited)
-            unedited_reads.update(unedited)
-            split_multiple_times.update(multi)
-            total_written += nwritten
-
-    with open(Path(output, 'edited.pkl'), 'wb') as handle:
-        pickle.dump(edited_reads, handle)
-    with open(Path(output, 'unedited.pkl'), 'wb') as handle:
-        pickle.dump(unedited_reads, handle)
-    if not allow_multiple_splits:
-        with open(Path(output, 'split_multiple_times.pkl'), 'wb') as handle:
-            pickle.dump(split_multiple_times, handle)
-    nedited_reads = len(edited_reads)
-    nunedited_reads = len(unedited_reads)
-    n_multisplit = len(split_multiple_times)
+    # Per-file read lists go to a scratch directory under numbered
+    # prefixes: inputs found by rglob may share a name across directories.
+    scratch = tempfile.TemporaryDirectory(dir=output)
+    prefixes = [
+        str(Path(scratch.name, str(i))) for i in range(len(fastxs))]
+    threads = threads or available_cpus()
+    if len(fastxs) == 1:
+        # a lone file gets every thread rather than a one-worker process pool
+        results = [worker(
+            fastxs[0], threads=threads, read_list_prefix=prefixes[0])]
+    else:
+        # Largest files first, so the run does not end with one big file
+        # still going while the other workers sit idle.
+        order = sorted(
+            range(len(fastxs)), key=lambda i: fastxs[i].stat().st_size,
+            reverse=True)
+        with ProcessPoolExecutor(max_workers=threads) as executor:
+            futures = [
+                executor.submit(
+                    worker, fastxs[i], read_list_prefix=prefixes[i])
+                for i in order]
+            results = [future.result() for future in futures]
+    nedited_reads = nunedited_reads = n_multisplit = total_written = 0
+    for nedited, nunedited, nmulti, nwritten, read_lists in results:
+        nedited_reads += nedited
+        nunedited_reads += nunedited
+        n_multisplit += nmulti
+        total_written += nwritten
+
+    for name in READ_LISTS:
+        # nothing is recorded as split multiple times when that is allowed
+        if name != 'split_multiple_times' or not allow_multiple_splits:
+            merge_read_lists(
+                [read_lists[name] for *_, read_lists in results],
+                Path(output, f'{name}.txt.gz'))
+    scratch.cleanup()
     logger.info(f'{adapter_type}\t{fastq_dir}\t'
                 f'Split {nedited_reads} reads\t'
                 f'Kept {nunedited_reads} reads\t'
@@ -413,7 +566,7 @@ def argparser():
         "--threads", default=None, type=int,
         help=(
             "Number of worker threads. "
-            "Equal to number of logical CPUs by default."))
+            "Equal to number of CPUs available to the process by default."))
     parser.add_argument(
         "--n_bases_to_mask_tail", default=mask_size_default_tail, type=int,
         help=(
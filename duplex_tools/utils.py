@@ -1,4 +1,6 @@
 """Utilities for duplex-tools."""
+import os
+
 import pysam
 
 
@@ -10,3 +12,14 @@ def contains_references(pysam_bam: pysam.AlignmentFile):
 def is_ubam(pysam_bam: pysam.AlignmentFile):
     """Check whether a bam is uBAM."""
     return not contains_references(pysam_bam)
+
+
+def available_cpus():
+    """Count the CPUs this process may run on.
+
+    Respects taskset/cgroup affinity where the platform exposes it.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS or Windows
+        return os.cpu_count()
@@ -1,4 +1,5 @@
-from duplex_tools.split_on_adapter import find_mid_adaptor
+from duplex_tools.split_on_adapter import (
+    deduplicate_locations_first_key, find_mid_adaptor)
 from hypothesis import strategies as st, given, settings
 
 
@@ -18,3 +19,28 @@ def test_find_mid_adaptor_edlib():
     seq = f"{padding}{middle_seq}{padding}"
     res = find_mid_adaptor(seq, [middle_seq], print_alignment=True, print_threshold=12)
     assert res['editDistance'] == 0
+
+
+def test_find_mid_adaptor_bytes_matches_str():
+    middle_seq = "AGTCGTGTCA"
+    padding = "GTGTGGTGTG" * 20
+    seq = f"{padding}{middle_seq}{padding}"
+    res_str = find_mid_adaptor(seq, [middle_seq])
+    res_bytes = find_mid_adaptor(seq.encode(), [middle_seq], print_alignment=True)
+    assert res_bytes['editDistance'] == res_str['editDistance'] == 0
+    assert res_bytes['locations'] == res_str['locations']
+
+
+def test_find_mid_adaptor_bounded_miss():
+    padding = "GTGTGGTGTG" * 20
+    seq = f"{padding}{padding}{padding}"
+    res = find_mid_adaptor(seq, ["AAAAACCCCC"], edit_threshold=3)
+    assert res['editDistance'] == -1
+    res = find_mid_adaptor(seq, ["AAAAACCCCC", "GTGTGGTGTG"], edit_threshold=3)
+    assert res['editDistance'] == 0
+
+
+def test_deduplicate_locations_first_key():
+    result = {'locations': [(30, 40), (10, 20), (30, 41), (10, 19)]}
+    result = deduplicate_locations_first_key(result)
+    assert result['locations'] == [(10, 20), (30, 40)]
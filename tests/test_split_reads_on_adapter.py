@@ -1,3 +1,4 @@
+import gzip
 import io
 import tempfile
 from contextlib import redirect_stderr
@@ -9,7 +10,7 @@ import duplex_tools
 import pkg_resources
 import shutil
 import logging
-from duplex_tools.split_on_adapter import split
+from duplex_tools.split_on_adapter import map_batches_ordered, split
 
 
 def test_split_on_adapter(caplog):
@@ -31,6 +32,8 @@ def test_split_on_adapter(caplog):
     # Then (1) there are files created in the expected locations
     assert os.path.exists(dir)
     assert (Path(dir) / expected_file).is_file()
+    with gzip.open(Path(dir) / 'edited.txt.gz', 'rt') as fh:
+        assert fh.read().split() == ['200bases-tailhead-200bases']
 
     # Then (2) stdout from script contains the number of split reads
     print(output.getvalue())
@@ -74,3 +77,31 @@ def test_split_multiple_on_adapter(caplog):
 
     # Then (2) stdout from script contains the number of split reads
     assert "Split 1 reads" in ''.join(caplog.text)
+
+
+def test_split_same_named_files_in_subdirectories(caplog, tmp_path):
+    caplog.set_level(logging.INFO)
+    # Given two inputs sharing a file name in different subdirectories
+    filename_in = pkg_resources.resource_filename(
+        'tests.data.fastq_200-th-200', '200bases-tailhead-200bases.fastq')
+    for sub in ('a', 'b'):
+        (tmp_path / 'dup' / sub).mkdir(parents=True)
+        shutil.copy(filename_in, tmp_path / 'dup' / sub / 'reads0.fastq')
+    outdir = tmp_path / 'out'
+
+    split(tmp_path / 'dup', output_dir=outdir, threads=2)
+
+    # Then the read lists hold both files' reads and nothing else is left
+    with gzip.open(outdir / 'edited.txt.gz', 'rt') as fh:
+        assert fh.read().split() == ['200bases-tailhead-200bases'] * 2
+    assert sorted(p.name for p in outdir.iterdir()) == [
+        'edited.txt.gz', 'reads0_split.fastq.gz',
+        'split_multiple_times.txt.gz', 'unedited.txt.gz']
+    assert 'Split 2 reads' in ''.join(caplog.text)
+
+
+def test_map_batches_ordered_keeps_input_order():
+    records = list(range(10))
+    out = list(map_batches_ordered(
+        lambda batch: [x * 2 for x in batch], records, threads=3, batch_size=2))
+    assert out == [(x, x * 2) for x in records]
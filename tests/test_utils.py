@@ -1,7 +1,9 @@
+import os
+
 import pkg_resources
 import pysam
 
-from duplex_tools.utils import is_ubam
+from duplex_tools.utils import available_cpus, is_ubam
 
 mapped = pkg_resources.resource_filename('tests.data.summaries_for_pairing',
                                              'dorado_mapped.bam')
@@ -11,4 +13,8 @@ unmapped = pkg_resources.resource_filename('tests.data.summaries_for_pairing',
 
 def test_is_ubam():
     assert not is_ubam(pysam.AlignmentFile(mapped, check_sq=False))
-    assert is_ubam(pysam.AlignmentFile(unmapped, check_sq=False))
\ No newline at end of file
+    assert is_ubam(pysam.AlignmentFile(unmapped, check_sq=False))
+
+
+def test_available_cpus():
+    assert 1 <= available_cpus() <= os.cpu_count()